@@ -1,12 +1,16 @@
+import asyncio
+import functools
 import logging
+import pickle
 import ssl
+from collections import OrderedDict
 from contextlib import contextmanager, suppress
 from os import PathLike
 from typing import Literal
 
 import httpx
 
-from ._db import TransactionDatabase
+from ._db import SAFE_METHODS, DBError, StoredRow, TransactionDatabase
 
 type VerifyType = ssl.SSLContext | str | bool
 type PathType = PathLike | str | bytes
@@ -18,6 +22,13 @@ _installed = False
 _httpc_installed = False
 
 
+@functools.cache
+def _default_ssl_context(http2: bool) -> ssl.SSLContext:
+    # 시스템 인증서를 불러오는 비용이 크므로 한 번 만든 context를 transport끼리 공유함.
+    # httpcore가 연결마다 http2 여부에 따라 ALPN을 설정하므로 http2 여부별로 따로 만듦.
+    return ssl.create_default_context()
+
+
 class AsyncCatcherTransport(httpx.AsyncHTTPTransport):
     logger = DEFAULT_LOGGER
     valid_modes = "store", "use", "hybrid", "passive"
@@ -28,39 +39,100 @@ class AsyncCatcherTransport(httpx.AsyncHTTPTransport):
         mode: ModeType,
         *,
         verify: VerifyType | None = None,
+        flush_limit: int = 20,
+        response_cache_size: int = 64,
         **kwargs,
     ) -> None:
         if mode not in self.valid_modes:
             raise ValueError(f"mode should be within {self.valid_modes}, not {mode!r}.")
-
-        verify = ssl.create_default_context() if verify is None else verify
+        if flush_limit < 1:
+            raise ValueError(f"flush_limit should be positive, not {flush_limit!r}.")
+        if response_cache_size < 0:
+            raise ValueError(f"response_cache_size should not be negative, not {response_cache_size!r}.")
+
+        if verify is None:
+            # cert가 주어지면 httpx가 context에 인증서를 불러오므로 공유하지 않고 새로 만듦.
+            if kwargs.get("cert") is None:
+                verify = _default_ssl_context(bool(kwargs.get("http2")))
+            else:
+                verify = ssl.create_default_context()
         super().__init__(verify=verify, **kwargs)
         self.db = db
         self.mode = mode
+        self.flush_limit = flush_limit
+        self.response_cache_size = response_cache_size
+        # 아직 기록되지 않은 응답. 요청의 key로 찾을 수 있도록 dict에 보관함.
+        self._waiting_flush: dict[bytes, StoredRow] = {}
+        # 진행 중인 flush가 있으면 그 flush가 끝날 때 set되는 event
+        self._flush_done: asyncio.Event | None = None
+        # 응답 객체는 client가 수정하므로 pickle 데이터를 캐시하고 매번 새 객체를 만들어 반환함.
+        self._response_cache: OrderedDict[bytes, bytes] = OrderedDict()
 
     @classmethod
     @contextmanager
-    def with_db(cls, db_path: PathType, mode: ModeType, table_name: str = "transactions"):
+    def with_db(cls, db_path: PathType, mode: ModeType, table_name: str = "transactions", **kwargs):
         with TransactionDatabase(db_path, table_name, flag="c") as db:
-            yield cls(db=db, mode=mode)
+            transport = cls(db=db, mode=mode, **kwargs)
+            try:
+                yield transport
+            finally:
+                transport.flush()
+
+    def flush(self) -> None:
+        if not self._waiting_flush:
+            return
+        rows = list(self._waiting_flush.values())
+        self.db.store_rows(rows)
+        self._discard_flushed(rows)
+
+    async def aflush(self) -> None:
+        # 같은 행을 두 번 기록하지 않도록 진행 중인 flush가 끝나길 기다린 뒤 남은 행을 기록함.
+        while self._flush_done is not None:
+            await self._flush_done.wait()
+        if not self._waiting_flush:
+            return
+        # 기록은 다른 스레드에서 진행해 이벤트 루프가 막히지 않도록 함.
+        rows = list(self._waiting_flush.values())
+        self._flush_done = flush_done = asyncio.Event()
+        try:
+            await asyncio.to_thread(self.db.store_rows, rows)
+        finally:
+            self._flush_done = None
+            flush_done.set()
+        self._discard_flushed(rows)
+
+    def _discard_flushed(self, rows: list[StoredRow]) -> None:
+        # 기록에 성공한 행만 대기열에서 제거함. 기록하는 동안 같은 key로 새로 들어온 행은 남겨 둠.
+        for row in rows:
+            if self._waiting_flush.get(row[0]) is row:
+                del self._waiting_flush[row[0]]
 
     async def store_async_requests(self, request: httpx.Request, response: httpx.Response) -> None:
         # content에 대한 fetching이 무조건 끝나도록 강제함.
         # 대부분의 경우에는 flushing만으로도 충분하지만
         # content와 await 사이가 remote한 아주 일부 경우 (썸네일 다운로드 등) flushing으로 부족함.
-        request.read()
+        await request.aread()
         await response.aread()
-        self.db[request] = response
+        # client가 응답을 돌려받은 뒤 수정하기 전에 미리 직렬화해 둠.
+        row = self.db.prepare(request, response)
+        self._waiting_flush[row[0]] = row
+        # 이미 flush가 진행 중이라면 기다리지 않고 남은 행은 다음 flush에 맡김.
+        if len(self._waiting_flush) >= self.flush_limit and self._flush_done is None:
+            try:
+                await self.aflush()
+            except DBError:
+                # 이 요청과 상관없는 기록 실패이므로 요청은 그대로 진행하고, 실패한 행은 다음 flush 때 다시 기록함.
+                self.logger.exception("Failed to flush %d captured responses; they will be retried.", len(self._waiting_flush))
 
     def find_request(self, request: httpx.Request, *, _comprehensive_error: bool = True) -> httpx.Response:
         try:
-            response = self.db[request]
+            response = pickle.loads(self._lookup(request))
         except KeyError:
             if not _comprehensive_error:
                 raise ValueError(request)
 
             method = "" if request.method == "GET" else request.method + " "
-            content = request.content
+            content = b"" if request.method in SAFE_METHODS else request.content
             if not content:
                 raise ValueError(
                     f"Could not find a {method}response for {request.url}")
@@ -75,14 +147,44 @@ class AsyncCatcherTransport(httpx.AsyncHTTPTransport):
         # response.stream = None
         return response
 
+    def _lookup(self, request: httpx.Request) -> bytes:
+        key = self.db.request_key(request)
+        # hybrid 모드에서 아직 기록되지 않은 응답도 찾을 수 있도록 함.
+        row = self._waiting_flush.get(key)
+        if row is not None:
+            return row[-1]
+
+        # use와 hybrid 모드에서는 이미 저장된 응답이 덮어써지지 않으므로 캐시가 오래될 일이 없음.
+        if self.mode not in ("use", "hybrid") or not self.response_cache_size:
+            return self.db.lookup(key)
+
+        cache = self._response_cache
+        try:
+            data = cache[key]
+        except KeyError:
+            data = cache[key] = self.db.lookup(key)
+            if len(cache) > self.response_cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return data
+
+    async def _ensure_read(self, request: httpx.Request) -> None:
+        # 스트리밍되는 본문은 요청을 보내고 나면 다시 읽을 수 없으므로 키를 만들거나 저장하기 전에 미리 읽어 둠.
+        if self.mode == "passive":
+            return
+        if self.mode == "use" and request.method in SAFE_METHODS:
+            return
+        await request.aread()
+
     async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._ensure_read(request)
+
         if self.mode == "use":
-            await request.aread()
             return self.find_request(request)
 
         if self.mode == "hybrid":
             with suppress(ValueError):
-                await request.aread()
                 return self.find_request(request)
 
         response = await super().handle_async_request(request)
@@ -91,6 +193,10 @@ class AsyncCatcherTransport(httpx.AsyncHTTPTransport):
 
         return response
 
+    async def aclose(self) -> None:
+        await self.aflush()
+        await super().aclose()
+
 
 def install(db_path: PathType, mode: ModeType):
     global _installed
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+import hashlib
 import json
 import os
 import pickle
+import queue
+import re
 import sqlite3
+import threading
 from pathlib import Path
-from contextlib import suppress, closing
+from contextlib import contextmanager, suppress, closing
 from collections.abc import MutableMapping
 import typing
+import zlib
 
 import httpx
 
@@ -16,12 +21,22 @@ class DBError(OSError):
     pass
 
 
+# 이 메서드들은 본문이 응답에 영향을 주지 않는다고 보고 키를 만들 때 본문을 무시함.
+SAFE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# 압축된 응답 앞에 붙는 태그. 코드가 b"\x01"인 pickle opcode는 없으므로
+# 어떤 protocol로 저장된 이전 버전의 데이터와도 구분됨.
+_COMPRESSED_TAG = b"\x01"
+_COMPRESSION_LEVEL = 1
+
+# key, method, url, headers, content, response 순서로 저장될 행. response는 압축하기 전의 pickle 데이터임.
+StoredRow = tuple[bytes, str, str, str, bytes, bytes]
+
 _ERR_CLOSED = "DBM object has already been closed"
 _ERR_REINIT = "DBM object does not support reinitialization"
 
 if typing.TYPE_CHECKING:
     RequestTuple = tuple[str, str, str, bytes]
-    NoHeadersRequestTuple = tuple[str, str, bytes]
 
 
 class TransactionDatabase(MutableMapping[httpx.Request, httpx.Response]):
@@ -32,9 +47,11 @@ class TransactionDatabase(MutableMapping[httpx.Request, httpx.Response]):
         *,
         flag: typing.Literal["r", "w", "c", "n"] = "c",
         mode: int = 0o666,
-        protocol: int = pickle.DEFAULT_PROTOCOL,
+        protocol: int = pickle.HIGHEST_PROTOCOL,
     ) -> None:
         self._protocol = protocol
+        # 다른 스레드에서 flush될 수 있으므로 쓰기 작업은 이 잠금으로 직렬화함.
+        self._lock = threading.Lock()
 
         if hasattr(self, "_cx"):
             raise DBError(_ERR_REINIT)
@@ -57,31 +74,116 @@ class TransactionDatabase(MutableMapping[httpx.Request, httpx.Response]):
                                  f"not {flag!r}")
 
         # We use the URI format when opening the database.
-        uri = self._normalize_uri(path)
-        uri = f"{uri}?mode={flagged}"
+        self._uri = self._normalize_uri(path)
+        uri = f"{self._uri}?mode={flagged}"
+        # 읽기 작업은 읽기 전용 연결을 따로 사용해 WAL 모드에서 쓰기와 동시에 진행될 수 있도록 함.
+        self._readers: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+        self._max_readers = min(8, os.cpu_count() or 1)
 
         try:
-            self._cx = sqlite3.connect(uri, autocommit=True, uri=True)
+            self._cx = sqlite3.connect(uri, autocommit=True, uri=True, check_same_thread=False)
         except sqlite3.Error as exc:
             raise DBError(str(exc))
 
         # This is an optimization only; it's ok if it fails.
         with suppress(sqlite3.OperationalError):
             self._cx.execute("PRAGMA journal_mode = wal")
+        pragmas = [
+            "PRAGMA synchronous = NORMAL",
+            "PRAGMA cache_size = -65536",
+            "PRAGMA temp_store = MEMORY",
+            "PRAGMA mmap_size = 268435456",
+            "PRAGMA wal_autocheckpoint = 10000",
+        ]
+        if flagged == "rwc":
+            pragmas.append("PRAGMA journal_size_limit = 67108864")
+        for pragma in pragmas:
+            with suppress(sqlite3.OperationalError):
+                self._cx.execute(pragma)
 
         self._build_queries(table)
 
         if flagged == "rwc":
             self._execute(self._build_table)
+        if flagged == "ro":
+            if not self._has_key_column():
+                self._cx.close()
+                self._cx = None
+                raise DBError(
+                    f"Table {table!r} was created by an older version of httpx-catcher; "
+                    "open it with flag 'w' or 'c' once to migrate it"
+                )
+        else:
+            self._add_key_column()
+            # flag가 'w'이고 테이블이 없는 경우에는 실패할 수 있음.
+            with suppress(sqlite3.OperationalError):
+                self._cx.execute(self._build_index)
 
     def _execute(self, *args, **kwargs):
         if not self._cx:
             raise DBError(_ERR_CLOSED)
         try:
-            return closing(self._cx.execute(*args, **kwargs))
+            return self._cx.execute(*args, **kwargs)
         except sqlite3.Error as exc:
             raise DBError(str(exc))
 
+    @contextmanager
+    def _reader(self) -> typing.Iterator[sqlite3.Connection]:
+        if not self._cx:
+            raise DBError(_ERR_CLOSED)
+        try:
+            cx = self._readers.get_nowait()
+        except queue.Empty:
+            try:
+                cx = sqlite3.connect(f"{self._uri}?mode=ro", autocommit=True, uri=True, check_same_thread=False)
+            except sqlite3.Error as exc:
+                raise DBError(str(exc))
+            with suppress(sqlite3.OperationalError):
+                cx.execute("PRAGMA mmap_size = 268435456")
+        try:
+            yield cx
+        finally:
+            if self._cx and self._readers.qsize() < self._max_readers:
+                self._readers.put(cx)
+            else:
+                cx.close()
+
+    @contextmanager
+    def _transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        with self._lock:
+            if not self._cx:
+                raise DBError(_ERR_CLOSED)
+            try:
+                # 쓰기 잠금을 처음부터 잡아 트랜잭션 도중에 잠금을 올리다 실패하는 일을 막음.
+                self._cx.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._cx
+                except BaseException:
+                    self._cx.execute("ROLLBACK")
+                    raise
+                self._cx.execute("COMMIT")
+            except sqlite3.Error as exc:
+                raise DBError(str(exc))
+
+    def _has_key_column(self) -> bool:
+        # 테이블이 아직 없는 경우에도 True를 반환함.
+        columns = [row[1] for row in self._cx.execute(self._table_info)]
+        return not columns or "key" in columns
+
+    def _add_key_column(self) -> None:
+        # key 열이 없는 이전 버전의 테이블에 key 열을 추가하고 값을 채워 넣음.
+        if self._has_key_column():
+            return
+        with self._transaction() as cx:
+            cx.execute(self._add_key)
+            rows = cx.execute(self._iter_legacy_rows).fetchall()
+            cx.executemany(self._update_key, (
+                (self._make_key(method, url, content), rowid)
+                for rowid, method, url, content in rows
+            ))
+            # 본문만 다른 GET 요청 등은 같은 키를 가지게 되므로 가장 나중에 저장된 것만 남김.
+            cx.execute(self._delete_duplicated_keys)
+
     def _build_queries(self, table: str) -> None:
         if not table.isidentifier():
             raise ValueError(f"Table name must be an identifier, not {table!r}")
@@ -93,6 +195,7 @@ class TransactionDatabase(MutableMapping[httpx.Request, httpx.Response]):
 
         self._build_table = f"""
         CREATE TABLE IF NOT EXISTS {table} (
+            key BLOB NOT NULL,
             method TEXT NOT NULL,
             url TEXT NOT NULL,
             headers TEXT NOT NULL,
@@ -100,41 +203,66 @@ class TransactionDatabase(MutableMapping[httpx.Request, httpx.Response]):
             response BLOB NOT NULL
         )
         """
+        self._build_index = f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {table}_key ON {table} (key)
+        """
+        self._table_info = f"PRAGMA table_info({table})"
+        self._add_key = f"ALTER TABLE {table} ADD COLUMN key BLOB"
+        self._iter_legacy_rows = f"SELECT rowid, method, url, content FROM {table}"
+        self._update_key = f"UPDATE {table} SET key = CAST(? AS BLOB) WHERE rowid = ?"
+        self._delete_duplicated_keys = f"DELETE FROM {table} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {table} GROUP BY key)"
         self._get_size = f"SELECT COUNT (url) FROM {table}"
         self._lookup_key = f"""
-        SELECT response FROM {table} WHERE (
-            method = CAST(? AS TEXT)
-            AND url = CAST(? AS TEXT)
-            AND content = CAST(? AS BLOB)
-        )
+        SELECT response FROM {table} WHERE key = CAST(? AS BLOB)
         """
         self._store_kv = f"""
-        INSERT INTO {table} (method, url, headers, content, response) VALUES (
-            CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS BLOB), CAST(? AS BLOB)
-        )
+        INSERT INTO {table} (key, method, url, headers, content, response) VALUES (
+            CAST(? AS BLOB), CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS TEXT), CAST(? AS BLOB), CAST(? AS BLOB)
+        ) ON CONFLICT (key) DO UPDATE SET
+            method = excluded.method, url = excluded.url, headers = excluded.headers,
+            content = excluded.content, response = excluded.response
+        WHERE method IS NOT excluded.method OR url IS NOT excluded.url OR headers IS NOT excluded.headers
+            OR content IS NOT excluded.content OR response IS NOT excluded.response
         """
-        self._delete_key = f"""DELETE FROM {table} WHERE (
-            method = CAST(? AS TEXT)
-            AND url = CAST(? AS TEXT)
-            AND content = CAST(? AS BLOB)
-        )"""
-        self._iter_keys = f"SELECT (method, url, headers, content) FROM {table}"
+        self._delete_key = f"DELETE FROM {table} WHERE key = CAST(? AS BLOB)"
+        self._iter_keys = f"SELECT method, url, headers, content FROM {table}"
         self._drop_table = f"DROP TABLE {table}"
 
     @staticmethod
     def _normalize_uri(path: Path) -> str:
-        uri = path.absolute().as_uri()
-        while "//" in uri:
-            uri = uri.replace("//", "/")
-        return uri
+        return re.sub("/{2,}", "/", path.absolute().as_uri())
 
     @staticmethod
     def _disassemble_request(request: httpx.Request) -> RequestTuple:
         return request.method, str(request.url), json.dumps(dict(request.headers)), request.content
 
     @staticmethod
-    def _disassemble_request_without_headers(request: httpx.Request) -> NoHeadersRequestTuple:
-        return request.method, str(request.url), request.content
+    def _make_key(method: str, url: str, content: bytes) -> bytes:
+        # 요청 본문 전체 대신 고정된 길이의 digest를 키로 사용함.
+        hashed = hashlib.blake2b(digest_size=16)
+        hashed.update(method.encode())
+        hashed.update(b"\0")
+        hashed.update(url.encode())
+        hashed.update(b"\0")
+        if method not in SAFE_METHODS:
+            hashed.update(content)
+        return hashed.digest()
+
+    @classmethod
+    def request_key(cls, request: httpx.Request) -> bytes:
+        # 본문을 읽지 않은 요청도 처리할 수 있도록 필요할 때만 content에 접근함.
+        content = b"" if request.method in SAFE_METHODS else request.content
+        return cls._make_key(request.method, str(request.url), content)
+
+    @staticmethod
+    def _compress_response(data: bytes) -> bytes:
+        return _COMPRESSED_TAG + zlib.compress(data, _COMPRESSION_LEVEL)
+
+    @staticmethod
+    def _decompress_response(data: bytes) -> bytes:
+        if data[:1] == _COMPRESSED_TAG:
+            return zlib.decompress(memoryview(data)[1:])
+        return data
 
     @staticmethod
     def _assemble_request(request_tuple: RequestTuple) -> httpx.Request:
@@ -142,43 +270,75 @@ class TransactionDatabase(MutableMapping[httpx.Request, httpx.Response]):
         return httpx.Request(method, url, headers=json.loads(headers), content=content)
 
     def __len__(self) -> int:
-        with self._execute(self._get_size) as cu:
-            row = cu.fetchone()
-        return row[0]
+        return self._execute(self._get_size).fetchone()[0]
 
     def __getitem__(self, request: httpx.Request) -> httpx.Response:
-        with self._execute(self._lookup_key, self._disassemble_request_without_headers(request)) as cu:
-            row = cu.fetchone()
+        try:
+            data = self.lookup(self.request_key(request))
+        except KeyError:
+            raise KeyError(request) from None
+        return pickle.loads(data)
+
+    def lookup(self, key: bytes) -> bytes:
+        # 역직렬화하기 전의 pickle 데이터를 반환함.
+        with self._reader() as cx:
+            try:
+                row = cx.execute(self._lookup_key, (key,)).fetchone()
+            except sqlite3.Error as exc:
+                raise DBError(str(exc))
         if not row:
-            raise KeyError(request)
-        return pickle.loads(row[0])
+            raise KeyError(key)
+        return self._decompress_response(row[0])
 
     def __setitem__(self, request: httpx.Request, response: httpx.Response) -> None:
-        with suppress(KeyError):
-            del self[request]
-        self._execute(self._store_kv, (*self._disassemble_request(request), pickle.dumps(response, protocol=self._protocol)))
+        self.setmany(((request, response),))
+
+    def setmany(self, pairs: typing.Iterable[tuple[httpx.Request, httpx.Response]]) -> None:
+        # 직렬화는 트랜잭션을 시작하기 전에 모두 끝내 쓰기 잠금을 잡고 있는 시간을 줄임.
+        self.store_rows([self.prepare(request, response) for request, response in pairs])
+
+    def prepare(self, request: httpx.Request, response: httpx.Response) -> StoredRow:
+        return (
+            self.request_key(request),
+            *self._disassemble_request(request),
+            pickle.dumps(response, protocol=self._protocol),
+        )
+
+    def store_rows(self, rows: typing.Sequence[StoredRow]) -> None:
+        if not rows:
+            return
+        # 압축은 prepare()가 아닌 여기서 해 flush하는 스레드에서 진행되도록 함.
+        rows = [(*row[:-1], self._compress_response(row[-1])) for row in rows]
+        # 모든 쓰기를 하나의 트랜잭션으로 묶어 commit 비용을 한 번만 지불함.
+        with self._transaction() as cx:
+            cx.executemany(self._store_kv, rows)
 
     def __delitem__(self, request: httpx.Request) -> None:
-        with self._execute(self._delete_key, self._disassemble_request_without_headers(request)) as cu:
-            if not cu.rowcount:
+        with self._lock:
+            if not self._execute(self._delete_key, (self.request_key(request),)).rowcount:
                 raise KeyError(request)
 
     def __iter__(self) -> typing.Iterator[httpx.Request]:
         try:
-            with self._execute(self._iter_keys) as cu:
+            with closing(self._execute(self._iter_keys)) as cu:
                 for row in cu:
                     yield self._assemble_request(row)
         except sqlite3.Error as exc:
             raise DBError(str(exc))
 
     def close(self) -> None:
-        if self._cx:
-            self._cx.close()
-            self._cx = None
+        with self._lock:
+            # 읽기 전용 연결은 WAL 파일을 정리할 수 없으므로 쓰기 연결을 마지막에 닫음.
+            while not self._readers.empty():
+                self._readers.get_nowait().close()
+            if self._cx:
+                self._cx.close()
+                self._cx = None
 
     def drop(self) -> None:
         try:
-            self._execute(self._drop_table)
+            with self._lock:
+                self._execute(self._drop_table)
         except sqlite3.Error as exc:
             raise DBError(str(exc))
 
@@ -1,8 +1,12 @@
 import asyncio
+import pickle
+import sqlite3
+import ssl
+import threading
 from pathlib import Path
 import httpc
 import httpx
-from httpx_catcher import AsyncCatcherTransport, TransactionDatabase, DBError
+from httpx_catcher import AsyncCatcherTransport, TransactionDatabase, DBError, ModeType
 import pytest
 
 RESOURCE_DIR = Path(__file__).parent.joinpath("resource")
@@ -30,6 +34,286 @@ def test_db():
         db_path.unlink(missing_ok=True)
 
 
+def test_setmany():
+    RESOURCE_DIR.mkdir(exist_ok=True)
+
+    db_path = RESOURCE_DIR / "test_setmany.db"
+    db = TransactionDatabase(db_path, "Test")
+    try:
+        req1 = httpx.Request("GET", "https://hello.world")
+        req2 = httpx.Request("POST", "https://hello.world", content=b"hello")
+        db.setmany([
+            (req1, httpx.Response(200, text="first")),
+            (req2, httpx.Response(201, text="second")),
+            (req1, httpx.Response(200, text="overwritten")),
+        ])
+        assert len(db) == 2
+        assert {(req.method, str(req.url), req.content) for req in db} == {
+            ("GET", "https://hello.world", b""),
+            ("POST", "https://hello.world", b"hello"),
+        }
+        assert db[req1].text == "overwritten"
+        assert db[req2].status_code == 201
+
+        db.setmany([])
+        assert len(db) == 2
+
+        # GET 요청은 본문이 키에 포함되지 않지만 저장된 본문은 새 요청의 것으로 바뀌어야 함.
+        db[httpx.Request("GET", "https://hello.world", content=b"new")] = httpx.Response(200, text="new")
+        assert len(db) == 2
+        assert {req.content for req in db if req.method == "GET"} == {b"new"}
+        assert db[req1].text == "new"
+    finally:
+        db.close()
+        db_path.unlink(missing_ok=True)
+
+
+@pytest.mark.parametrize("protocol", [0, 1, pickle.HIGHEST_PROTOCOL])
+def test_uncompressed_response(tmp_path, protocol):
+    db_path = tmp_path / "test.db"
+    req = httpx.Request("GET", "https://hello.world")
+    with TransactionDatabase(db_path, "Test") as db:
+        db[req] = httpx.Response(200, text="compressed")
+        # 압축 태그가 붙지 않은 이전 버전의 응답을 직접 기록함.
+        db._cx.execute("UPDATE Test SET response = ?", (pickle.dumps(httpx.Response(200, text="legacy"), protocol=protocol),))
+        assert db[req].text == "legacy"
+
+
+def create_legacy_table(db_path: Path, rows: list[tuple[str, str, bytes, httpx.Response]]) -> None:
+    # key 열이 없던 이전 버전의 테이블을 만듦.
+    with sqlite3.connect(db_path) as cx:
+        cx.execute(
+            "CREATE TABLE Test (method TEXT NOT NULL, url TEXT NOT NULL, headers TEXT NOT NULL,"
+            " content BLOB NOT NULL, response BLOB NOT NULL)"
+        )
+        cx.executemany(
+            "INSERT INTO Test VALUES (?, ?, '{}', ?, ?)",
+            [(method, url, content, pickle.dumps(response)) for method, url, content, response in rows],
+        )
+    cx.close()
+
+
+def test_legacy_migration(tmp_path):
+    db_path = tmp_path / "legacy.db"
+    create_legacy_table(db_path, [
+        ("GET", "https://hello.world", b"old body", httpx.Response(200, text="old")),
+        ("GET", "https://hello.world", b"new body", httpx.Response(200, text="new")),
+        ("POST", "https://hello.world", b"hello", httpx.Response(201, text="post")),
+    ])
+
+    # 읽기 전용으로는 migration을 할 수 없으므로 명확한 오류를 냄.
+    with pytest.raises(DBError, match="older version"):
+        TransactionDatabase(db_path, "Test", flag="r")
+
+    with TransactionDatabase(db_path, "Test", flag="w") as db:
+        # 본문만 다른 GET 요청은 가장 나중에 저장된 것만 남음.
+        assert len(db) == 2
+        assert db[httpx.Request("GET", "https://hello.world")].text == "new"
+        assert db[httpx.Request("POST", "https://hello.world", content=b"hello")].text == "post"
+
+    with TransactionDatabase(db_path, "Test", flag="r") as db:
+        assert db[httpx.Request("GET", "https://hello.world")].text == "new"
+
+
+@pytest.fixture
+def db_path():
+    RESOURCE_DIR.mkdir(exist_ok=True)
+    db_path = RESOURCE_DIR / "test_transport.db"
+    yield db_path
+    db_path.unlink(missing_ok=True)
+
+
+@pytest.fixture
+def network(monkeypatch):
+    # 실제 네트워크 대신 요청을 기록하고 간단한 응답을 돌려줌.
+    sent: list[httpx.Request] = []
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        sent.append(request)
+        if request.url.path == "/redirect":
+            return httpx.Response(302, headers={"location": "/target"})
+        return httpx.Response(200, content=request.method.encode() + b" " + request.content)
+
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, "handle_async_request", handle_async_request)
+    return sent
+
+
+def test_store_snapshots_response(db_path, network):
+    async def main():
+        with AsyncCatcherTransport.with_db(db_path, "store", flush_limit=2) as transport:
+            # client가 응답에 넣는 함수나 history는 저장되지 않아야 함.
+            async with httpx.AsyncClient(
+                transport=transport, default_encoding=lambda content: "utf-8", follow_redirects=True
+            ) as client:
+                await client.get("https://hello.world/first")
+                await client.get("https://hello.world/redirect")
+
+    asyncio.run(main())
+    with TransactionDatabase(db_path, "transactions") as db:
+        assert len(db) == 3
+        assert db[httpx.Request("GET", "https://hello.world/target")].history == []
+
+
+def test_hybrid_pending_and_failed_flush(db_path, network):
+    async def main(transport: AsyncCatcherTransport):
+        for _ in range(3):
+            response = await transport.handle_async_request(httpx.Request("GET", "https://hello.world"))
+            await response.aread()
+            assert response.content == b"GET "
+
+    with AsyncCatcherTransport.with_db(db_path, "hybrid", flush_limit=100) as transport:
+        asyncio.run(main(transport))
+        # 기록되지 않은 응답도 다시 요청하지 않고 찾아야 함.
+        assert len(network) == 1
+        assert len(transport.db) == 0
+
+        def fail(rows):
+            raise DBError("disk I/O error")
+
+        transport.db.store_rows = fail
+        with pytest.raises(DBError):
+            transport.flush()
+        del transport.db.store_rows
+
+        # 기록에 실패한 응답은 대기열에 남아 있다가 다음 flush 때 기록됨.
+        asyncio.run(main(transport))
+        assert len(network) == 1
+        transport.flush()
+        assert len(transport.db) == 1
+        assert not transport._waiting_flush
+
+
+def test_background_flush_failure(db_path, network, caplog):
+    async def main(transport: AsyncCatcherTransport):
+        for i in range(2):
+            response = await transport.handle_async_request(httpx.Request("POST", "https://hello.world", content=f"{i}"))
+            await response.aread()
+
+    with AsyncCatcherTransport.with_db(db_path, "store", flush_limit=2) as transport:
+        def fail(rows):
+            raise DBError("disk I/O error")
+
+        # 기록 실패는 flush_limit에 도달한 요청으로 전달되지 않고 기록만 됨.
+        transport.db.store_rows = fail
+        asyncio.run(main(transport))
+        del transport.db.store_rows
+        assert "Failed to flush 2 captured responses" in caplog.text
+        assert len(transport._waiting_flush) == 2
+
+    with TransactionDatabase(db_path, "transactions") as db:
+        assert len(db) == 2
+
+
+def test_close_waits_for_flush(tmp_path, network):
+    release = threading.Event()
+    flushed: list[int] = []
+
+    with TransactionDatabase(tmp_path / "test.db", "Test") as db:
+        store_rows = db.store_rows
+
+        def slow_store_rows(rows):
+            flushed.append(len(rows))
+            release.wait()
+            store_rows(rows)
+
+        db.store_rows = slow_store_rows
+        transport = AsyncCatcherTransport(db, "store", flush_limit=1)
+
+        async def send(i: int) -> None:
+            await transport.handle_async_request(httpx.Request("POST", "https://hello.world", content=f"{i}"))
+
+        async def main():
+            first = asyncio.create_task(send(0))
+            while not flushed:
+                await asyncio.sleep(0.01)
+            # flush가 진행 중일 때 들어온 응답은 기다리지 않고 대기열에 남음.
+            await send(1)
+            assert len(transport._waiting_flush) == 2
+
+            # aclose()는 진행 중인 flush가 끝나길 기다린 뒤 남은 응답까지 기록해야 함.
+            closing = asyncio.create_task(transport.aclose())
+            await asyncio.sleep(0.01)
+            release.set()
+            await closing
+            await first
+
+        asyncio.run(main())
+        assert flushed == [1, 1]
+        assert not transport._waiting_flush
+        assert len(db) == 2
+
+
+def test_streamed_request_body(db_path, network):
+    async def body():
+        yield b"stream"
+        yield b"ed"
+
+    async def main(mode: ModeType) -> bytes:
+        with AsyncCatcherTransport.with_db(db_path, mode) as transport:
+            async with httpx.AsyncClient(transport=transport) as client:
+                response = await client.post("https://hello.world", content=body())
+                return response.content
+
+    assert asyncio.run(main("store")) == b"POST streamed"
+    assert asyncio.run(main("use")) == b"POST streamed"
+    assert len(network) == 1
+
+
+def test_response_cache(tmp_path):
+    db_path = tmp_path / "test.db"
+    with TransactionDatabase(db_path, "Test") as db:
+        requests = [httpx.Request("GET", f"https://hello.world/{i}") for i in range(3)]
+        db.setmany((req, httpx.Response(200, text=str(i))) for i, req in enumerate(requests))
+
+        lookups = []
+        lookup = db.lookup
+        db.lookup = lambda key: lookups.append(key) or lookup(key)
+
+        transport = AsyncCatcherTransport(db, "use", response_cache_size=2)
+        first = transport.find_request(requests[0])
+        second = transport.find_request(requests[0])
+        assert len(lookups) == 1
+        # 캐시에서 가져오더라도 매번 새로운 응답 객체를 반환함.
+        assert first is not second
+        assert first.text == second.text == "0"
+
+        transport.find_request(requests[1])
+        transport.find_request(requests[2])
+        assert len(lookups) == 3
+        # 가장 오래된 응답이 캐시에서 밀려남.
+        transport.find_request(requests[0])
+        assert len(lookups) == 4
+        transport.find_request(requests[2])
+        assert len(lookups) == 4
+
+        uncached = AsyncCatcherTransport(db, "use", response_cache_size=0)
+        uncached.find_request(requests[0])
+        uncached.find_request(requests[0])
+        assert len(lookups) == 6
+
+
+def test_ssl_context_sharing(tmp_path, monkeypatch):
+    contexts = []
+    # 실제 transport를 만들지 않고 httpx로 넘겨지는 verify만 기록함.
+    monkeypatch.setattr(httpx.AsyncHTTPTransport, "__init__", lambda self, *, verify, **kwargs: contexts.append(verify))
+
+    with TransactionDatabase(tmp_path / "test.db", "Test") as db:
+        AsyncCatcherTransport(db, "passive")
+        AsyncCatcherTransport(db, "passive")
+        AsyncCatcherTransport(db, "passive", http2=True)
+        # cert를 사용하는 transport의 인증서가 다른 transport로 새어 나가지 않아야 함.
+        AsyncCatcherTransport(db, "passive", cert="cert.pem")
+        AsyncCatcherTransport(db, "passive", verify=False)
+
+    plain, shared, http2, with_cert, unverified = contexts
+    assert isinstance(plain, ssl.SSLContext)
+    assert shared is plain
+    # http2 여부에 따라 httpcore가 ALPN을 다르게 설정하므로 context를 따로 사용함.
+    assert http2 is not plain
+    assert with_cert is not plain and with_cert is not http2
+    assert unverified is False
+
+
 @pytest.mark.skip
 def test_catcher():
     asyncio.run(async_test_catcher())
@@ -40,6 +324,7 @@ async def async_test_catcher():
     with AsyncCatcherTransport.with_db(db_path, "hybrid") as transport:
         async with httpc.AsyncClient(transport=transport) as client:
             res = await client.get("https://www.google.com", headers={"hello": "world"})
+            transport.flush()
             req = httpx.Request("GET", "https://www.google.com", headers={"hello": "world"})
             assert transport.db[req]
 